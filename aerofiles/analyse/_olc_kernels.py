@@ -0,0 +1,44 @@
+"""
+Ahead-of-time build of the compiled kernels of the scorer. Running
+
+    python -m aerofiles.analyse._olc_kernels
+
+writes the olc_kernels extension module next to score.py. Scorer uses it
+instead of the jitted kernels if use_aot_kernels is set, so a process with
+a cold numba cache does not compile anything before scoring a flight.
+The AOT kernels run serially on a generic CPU target. Only use them where
+compilation dominates, e.g. short lived or single threaded processes; a
+warm parallel JIT kernel is considerably faster.
+"""
+import os
+
+from numba.pycc import CC
+
+from aerofiles.analyse.score import (
+    _find_graph, _find_start_graph, _rdp_mask, _update_graphs
+)
+
+cc = CC('olc_kernels')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+cc.export(
+    'rdp_mask',
+    'b1[::1](f8[::1], f8[::1], f8)'
+)(_rdp_mask.py_func)
+cc.export(
+    'find_graph',
+    'Tuple((f4[:,::1], i4[:,::1]))(f4[::1], f4[::1], i8, b1[::1])'
+)(_find_graph.py_func)
+cc.export(
+    'find_start_graph',
+    'i4[:,::1](i4[:,::1])'
+)(_find_start_graph.py_func)
+cc.export(
+    'update_graphs',
+    'Tuple((f4[:,:,::1], i4[:,:,::1]))(f4[::1], f4[::1], f4[:,::1], '
+    'i4[:,::1], i4[:,::1], b1[:,::1], i8[::1], f4[:,:,::1], i4[:,:,::1])'
+)(_update_graphs.py_func)
+
+
+if __name__ == '__main__':
+    cc.compile()
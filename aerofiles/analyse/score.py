@@ -1,14 +1,357 @@
 import os
 import numpy as np
-import scipy
 import datetime as dt
-from sklearn.neighbors import DistanceMetric
-from math import radians
+import math
+import numba
+from numba import cuda, float32, int32, njit, prange
 
 from aerofiles.igc import Reader
-from aerofiles.util.geo import haversine
+from aerofiles.util.geo import EARTH_RADIUS_KM
 from aerofiles.analyse.config import FlightParsingConfig as Config
 
+try:
+    # optional, built by python -m aerofiles.analyse._olc_kernels
+    from aerofiles.analyse import olc_kernels
+except ImportError:
+    olc_kernels = None
+
+
+@njit(cache=True)
+def _rdp_mask(lat, lon, epsilon):
+    """
+    Ramer-Douglas-Peucker line simplification. Returns a boolean mask of the
+    points that are kept with the given tolerance. The recursion is replaced
+    by an explicit stack of segments.
+    Distances are measured to the segment, not to the line through its end
+    points, so fixes of an out-and-back leg beyond the segment are kept.
+    """
+    n = len(lat)
+    mask = np.ones(n, dtype=np.bool_)
+    if n < 3:
+        return mask
+    mask[1:n-1] = False
+
+    stack = np.empty((n, 2), dtype=np.int64)
+    stack[0, 0] = 0
+    stack[0, 1] = n-1
+    top = 1
+    while top > 0:
+        top -= 1
+        start = stack[top, 0]
+        end = stack[top, 1]
+
+        dlat = lat[end] - lat[start]
+        dlon = lon[end] - lon[start]
+        norm2 = dlat*dlat + dlon*dlon
+        dmax = -1.0
+        index = start
+        for i in range(start+1, end):
+            # closest point of the segment, clamped to its end points
+            t = 0.
+            if norm2 > 0:
+                t = ((lat[i]-lat[start])*dlat + (lon[i]-lon[start])*dlon) / norm2
+                t = min(max(t, 0.), 1.)
+            d = math.sqrt(
+                (lat[i]-lat[start]-t*dlat)**2 + (lon[i]-lon[start]-t*dlon)**2
+            )
+            if d > dmax:
+                dmax = d
+                index = i
+
+        if dmax > epsilon:
+            mask[index] = True
+            stack[top, 0] = start
+            stack[top, 1] = index
+            stack[top+1, 0] = index
+            stack[top+1, 1] = end
+            top += 2
+    return mask
+
+
+# Number of knots processed as one block in the DP
+BLOCK_SIZE = 256
+
+
+@njit(cache=True, fastmath=True)
+def _distance(x, y, k, i):
+    """
+    Distance of knots k and i in flat projection. The DP only needs pairs
+    with i <= k, each once per block sweep, so recalculating them is cheaper
+    than loading them from a stored (even condensed, triangular) matrix.
+    """
+    dx = x[k] - x[i]
+    dy = y[k] - y[i]
+    return math.sqrt(dx*dx + dy*dy)
+
+
+# Number of independent running maxima in _argmax_sum
+LANES = 32
+
+
+@njit(cache=True, fastmath=True)
+def _argmax_sum(a, b, n):
+    """
+    Maximum of a[:n] + b[:n] and the first index it is found at.
+    The scan keeps LANES running maxima with their indices and updates them
+    with selects instead of branches, which the compiler turns into SIMD
+    max and blend instructions. The lanes are merged at the end, preferring
+    the lower index on ties.
+    """
+    lane_best = np.full(LANES, np.float32(-3e38))
+    lane_idx = np.zeros(LANES, dtype=np.int32)
+    m = n - n % LANES
+    for i0 in range(0, m, LANES):
+        for j in range(LANES):
+            v = a[i0+j] + b[i0+j]
+            c = v > lane_best[j]
+            lane_best[j] = v if c else lane_best[j]
+            lane_idx[j] = i0+j if c else lane_idx[j]
+
+    best = np.float32(-3e38)
+    best_idx = 0
+    for j in range(LANES):
+        if lane_best[j] > best or (lane_best[j] == best and lane_idx[j] < best_idx):
+            best = lane_best[j]
+            best_idx = lane_idx[j]
+    for i in range(m, n):
+        v = a[i] + b[i]
+        if v > best:
+            best = v
+            best_idx = i
+    return best, best_idx
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def _find_graph(x, y, layers, forbidden_mask):
+    """
+    Compiled kernel of Scorer.find_graph. Runs the triangular recurrence with
+    explicit scalar loops and calculates the distances on the fly from the
+    projected coordinates, so no (n,n) distance matrix is ever stored.
+    Knots are processed in blocks of BLOCK_SIZE. A block only depends on the
+    blocks before it: all layers of those are final, so the distance to
+    each earlier knot is calculated once and used for all layers. Within a
+    block, layer l+1 only reads from layer l, so the block is swept layer
+    by layer. The knots of a block are processed in parallel.
+    The argmax of each reduction is tracked in the same pass and stored in
+    the index graph.
+    """
+    knots = x.shape[0]
+    # rows are contiguous, so the scans over graph[l] are stride-1 loads
+    graph = np.zeros((layers, knots), dtype=np.float32)
+    index_graph = np.zeros((layers, knots), dtype=np.int32)
+    for k in range(knots):
+        if forbidden_mask[k]:
+            graph[0, k] = -1e10
+
+    best = np.empty((layers-1, BLOCK_SIZE), dtype=np.float32)
+    best_idx = np.empty((layers-1, BLOCK_SIZE), dtype=np.int32)
+    for k0 in range(0, knots, BLOCK_SIZE):
+        k1 = min(k0 + BLOCK_SIZE, knots)
+
+        # knots of the previous blocks
+        for k in prange(k0, k1):
+            j = k - k0
+            row = np.empty(k0, dtype=np.float32)
+            for i in range(k0):
+                row[i] = _distance(x, y, k, i)
+            for l in range(layers-1):
+                best[l, j], best_idx[l, j] = _argmax_sum(graph[l], row, k0)
+
+        # knots of this block
+        for l in range(layers-1):
+            for k in prange(k0, k1):
+                j = k - k0
+                b = best[l, j]
+                b_idx = best_idx[l, j]
+                for i in range(k0, k+1):
+                    v = graph[l, i] + _distance(x, y, k, i)
+                    if v > b:
+                        b = v
+                        b_idx = i
+                graph[l+1, k] = b
+                index_graph[l+1, k] = b_idx
+    return graph, index_graph
+
+
+# Simplified flights with at least this many knots use the GPU for the
+# unconstrained find_graph, if one is available
+CUDA_MIN_KNOTS = 30000
+CUDA_THREADS = 256
+
+
+@cuda.jit
+def _find_layer_cuda(x, y, graph_l, graph_lp1, index_lp1):
+    """
+    One layer of the DP on the GPU. Each block computes the cell of one knot
+    k: its threads scan a strided share of the knots up to k, then the
+    partial maxima are reduced in shared memory, preferring the lower index
+    on ties.
+    """
+    k = cuda.blockIdx.x
+    tid = cuda.threadIdx.x
+    shared_best = cuda.shared.array(CUDA_THREADS, float32)
+    shared_idx = cuda.shared.array(CUDA_THREADS, int32)
+
+    best = float32(-3e38)
+    best_idx = 0
+    for i in range(tid, k+1, CUDA_THREADS):
+        dx = x[k] - x[i]
+        dy = y[k] - y[i]
+        v = graph_l[i] + math.sqrt(dx*dx + dy*dy)
+        if v > best:
+            best = v
+            best_idx = i
+    shared_best[tid] = best
+    shared_idx[tid] = best_idx
+    cuda.syncthreads()
+
+    step = CUDA_THREADS // 2
+    while step > 0:
+        if tid < step:
+            other_best = shared_best[tid+step]
+            other_idx = shared_idx[tid+step]
+            if (other_best > shared_best[tid] or
+                    (other_best == shared_best[tid] and other_idx < shared_idx[tid])):
+                shared_best[tid] = other_best
+                shared_idx[tid] = other_idx
+        cuda.syncthreads()
+        step //= 2
+
+    if tid == 0:
+        graph_lp1[k] = shared_best[0]
+        index_lp1[k] = shared_idx[0]
+
+
+def _find_graph_cuda(x, y, layers, forbidden_mask):
+    """
+    Same result as _find_graph up to rounding, computed on the GPU. Layers
+    depend on each other and are launched one after another, the knots of a
+    layer run in parallel.
+    Only verified with the CUDA simulator so far, which computes in float64.
+    The rounding differs from _find_graph, so its graphs must not seed
+    _update_graphs. It is therefore only reached from score and
+    score_backwards, and only if at least CUDA_MIN_KNOTS knots remain after
+    the RDP simplification.
+    """
+    knots = x.shape[0]
+    graph = np.zeros((layers, knots), dtype=np.float32)
+    graph[0, forbidden_mask] = -1e10
+    index_graph = np.zeros((layers, knots), dtype=np.int32)
+
+    d_x = cuda.to_device(x)
+    d_y = cuda.to_device(y)
+    d_graph = cuda.to_device(graph)
+    d_index_graph = cuda.to_device(index_graph)
+    for l in range(layers-1):
+        _find_layer_cuda[knots, CUDA_THREADS](
+            d_x, d_y, d_graph[l], d_graph[l+1], d_index_graph[l+1]
+        )
+    return d_graph.copy_to_host(), d_index_graph.copy_to_host()
+
+
+@njit(cache=True)
+def _find_start_graph(index_graph):
+    """
+    Follows the index graph to store the start knot of the optimum path
+    ending at (l,k).
+    """
+    layers, knots = index_graph.shape
+    start_graph = np.empty((layers, knots), dtype=np.int32)
+    for k in range(knots):
+        start_graph[0, k] = k
+    for l in range(1, layers):
+        for k in range(knots):
+            start_graph[l, k] = start_graph[l-1, index_graph[l, k]]
+    return start_graph
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def _update_graphs(x, y, graph, index_graph, start_graph, forbidden_masks,
+                   reverse_froms, new_graph, new_index_graph):
+    """
+    Compiled kernel of Scorer.update_graphs, for a batch of end knots with
+    a forbidden mask each. Only knots up to reverse_froms[c] can be part of
+    a path ending there. Forbidding start knots only lowers values, so a
+    cell whose optimum path does not start at a forbidden knot keeps its
+    value and index. Only the remaining cells run the reduction again,
+    blocked like _find_graph. The knots of a block are processed in
+    parallel for all end knots of the batch at once.
+    The results are written to new_graph and new_index_graph, (c,l,k)
+    shaped buffers of the caller that may hold values of a previous batch.
+    Every cell is overwritten, so they do not need to be cleared.
+    """
+    layers, knots = graph.shape
+    batch = len(reverse_froms)
+    for c in range(batch):
+        for k in range(reverse_froms[c]+1):
+            new_graph[c, 0, k] = -1e10 if forbidden_masks[c, k] else 0.
+            new_index_graph[c, 0, k] = 0
+        new_graph[c, :, reverse_froms[c]+1:] = 0.
+        new_index_graph[c, :, reverse_froms[c]+1:] = 0
+
+    stop = reverse_froms.max() + 1
+    best = np.empty((batch, layers-1, BLOCK_SIZE), dtype=np.float32)
+    best_idx = np.empty((batch, layers-1, BLOCK_SIZE), dtype=np.int32)
+    for k0 in range(0, stop, BLOCK_SIZE):
+        k1 = min(k0 + BLOCK_SIZE, stop)
+        cells = batch * (k1-k0)
+
+        # knots of the previous blocks
+        for t in prange(cells):
+            c = t // (k1-k0)
+            j = t % (k1-k0)
+            k = k0 + j
+            if k > reverse_froms[c]:
+                continue
+            forbidden_mask = forbidden_masks[c]
+            dirty = False
+            for l in range(layers-1):
+                if forbidden_mask[start_graph[l+1, k]]:
+                    dirty = True
+            if not dirty:
+                continue
+            row = np.empty(k0, dtype=np.float32)
+            for i in range(k0):
+                row[i] = _distance(x, y, k, i)
+            for l in range(layers-1):
+                if not forbidden_mask[start_graph[l+1, k]]:
+                    continue
+                best[c, l, j], best_idx[c, l, j] = _argmax_sum(
+                    new_graph[c, l], row, k0
+                )
+
+        # knots of this block
+        for l in range(layers-1):
+            for t in prange(cells):
+                c = t // (k1-k0)
+                j = t % (k1-k0)
+                k = k0 + j
+                if k > reverse_froms[c]:
+                    continue
+                if not forbidden_masks[c, start_graph[l+1, k]]:
+                    new_graph[c, l+1, k] = graph[l+1, k]
+                    new_index_graph[c, l+1, k] = index_graph[l+1, k]
+                    continue
+                b = best[c, l, j]
+                b_idx = best_idx[c, l, j]
+                for i in range(k0, k+1):
+                    v = new_graph[c, l, i] + _distance(x, y, k, i)
+                    if v > b:
+                        b = v
+                        b_idx = i
+                new_graph[c, l+1, k] = b
+                new_index_graph[c, l+1, k] = b_idx
+    return new_graph, new_index_graph
+
+
+# Jitted kernels by the name they are exported with from olc_kernels
+JIT_KERNELS = {
+    'rdp_mask': _rdp_mask,
+    'find_graph': _find_graph,
+    'find_start_graph': _find_start_graph,
+    'update_graphs': _update_graphs,
+}
+
 
 class Scorer:
     """
@@ -18,14 +361,64 @@ class Scorer:
     def __init__(self, data=None, start=0, end=None):
 
         self.layers = 7
+        # tolerance in degrees of latitude used to simplify the track for
+        # score and score_backwards, set to 0 to score all fixes
+        self.epsilon = 3e-5
+        # number of end knots checked at once by the height constrained
+        # scoring, one per thread. The last batch may check a few more end
+        # knots than checking them one at a time would
+        self.batch_size = max(1, numba.config.NUMBA_NUM_THREADS)
+        # use the serial AOT kernels of olc_kernels instead of the jitted
+        # ones, which saves compiling them in a process with a cold cache
+        self.use_aot_kernels = False
         if data is not None:
             if end is None:
                 end = len(data['lon'])
             self.lon = data['lon'][start:end]
             self.lat = data['lat'][start:end]
             self.alt = data['alt'][start:end]
+            self._cache_derived()
         self.test_data_dir = 'aerofiles/analyse/test_data'
 
+    def _cache_derived(self):
+        """
+        Stores the fixes as (n,2) array of latitude and longitude in radians
+        and the altitudes sorted, together with the sorting permutation. The
+        data does not change after loading, so this is done once instead of
+        on every score call.
+        """
+        self.latlon_rad = np.radians(
+            np.column_stack([self.lat, self.lon])
+        ).astype(np.float32)
+        self.alt_argsort = np.argsort(self.alt, kind='stable')
+        self.alt_sorted = self.alt[self.alt_argsort]
+
+    def _set_records(self, records, utc_date):
+        """
+        Fills the fix arrays from the parsed records. All fields are taken
+        from a record in a single pass over the records, instead of one pass
+        per field.
+        """
+        lat = []
+        lon = []
+        alt = []
+        time = []
+        raw_time = []
+        for r in records:
+            t = r['time']
+            lat.append(r['lat'])
+            lon.append(r['lon'])
+            alt.append(r['pressure_alt'])
+            time.append(dt.datetime.combine(utc_date, t))
+            raw_time.append(((t.hour*60)+t.minute)*60+t.second)
+
+        self.lat = np.array(lat)
+        self.lon = np.array(lon)
+        self.alt = np.array(alt)
+        self.time = np.array(time)
+        self.raw_time = np.array(raw_time)
+        self._cache_derived()
+
     def import_torben_flight(self):
         tow_release = dt.time(9, 2, 0)
 
@@ -48,19 +441,13 @@ class Scorer:
         utc_date = parsed['header'][1]['utc_date']
 
         records = records[tow_release_index:]
-        self.lat = np.array([r['lat'] for r in records])
-        self.lon = np.array([r['lon'] for r in records])
-        self.time = np.array(
-            [dt.datetime.combine(utc_date, r['time']) for r in records]
-        )
-        self.raw_time = np.array([((r['time'].hour*60)+r['time'].minute)*60+r['time'].second for r in records])
-        self.alt = np.array([r['pressure_alt'] for r in records])
+        self._set_records(records, utc_date)
         self.sensor = np.array([r[sensors[0]] for r in records])
 
     def import_sebald1_flight(self):
         """https://www.onlinecontest.org/olc-3.0/gliding/flightinfo.html?dsId=6866743
 
-        37 iterations backward, 111 iterations forward
+        37 end knots checked backward, 111 forward (batch_size=1)
         We: 644.21 km
         OLC: 644.2 km
         """
@@ -78,13 +465,7 @@ class Scorer:
         utc_date = parsed['header'][1]['utc_date']
 
         records = records[tow_release_index:]
-        self.lat = np.array([r['lat'] for r in records])
-        self.lon = np.array([r['lon'] for r in records])
-        self.time = np.array(
-            [dt.datetime.combine(utc_date, r['time']) for r in records]
-        )
-        self.raw_time = np.array([((r['time'].hour*60)+r['time'].minute)*60+r['time'].second for r in records])
-        self.alt = np.array([r['pressure_alt'] for r in records])
+        self._set_records(records, utc_date)
 
     def import_sebald2_flight(self):
         """https://www.onlinecontest.org/olc-3.0/gliding/flightinfo.html?dsId=6582743
@@ -105,18 +486,12 @@ class Scorer:
         utc_date = parsed['header'][1]['utc_date']
 
         records = records[tow_release_index:]
-        self.lat = np.array([r['lat'] for r in records])
-        self.lon = np.array([r['lon'] for r in records])
-        self.time = np.array(
-            [dt.datetime.combine(utc_date, r['time']) for r in records]
-        )
-        self.raw_time = np.array([((r['time'].hour*60)+r['time'].minute)*60+r['time'].second for r in records])
-        self.alt = np.array([r['pressure_alt'] for r in records])
+        self._set_records(records, utc_date)
 
     def import_sebald3_flight(self):
         """https://www.onlinecontest.org/olc-3.0/gliding/flightinfo.html?dsId=7529473
 
-        63 iterations backward, 193 iterations forward
+        63 end knots checked backward, 193 forward (batch_size=1)
         OLC: 565.4 km
         We: 565.42 km
         """
@@ -134,18 +509,12 @@ class Scorer:
         utc_date = parsed['header'][1]['utc_date']
 
         records = records[tow_release_index:]
-        self.lat = np.array([r['lat'] for r in records])
-        self.lon = np.array([r['lon'] for r in records])
-        self.time = np.array(
-            [dt.datetime.combine(utc_date, r['time']) for r in records]
-        )
-        self.raw_time = np.array([((r['time'].hour*60)+r['time'].minute)*60+r['time'].second for r in records])
-        self.alt = np.array([r['pressure_alt'] for r in records])
+        self._set_records(records, utc_date)
 
     def import_sebald4_flight(self):
         """https://www.onlinecontest.org/olc-3.0/gliding/flightinfo.html?dsId=7396225
 
-        17 iterations backward, 56 iterations forward
+        17 end knots checked backward, 56 forward (batch_size=1)
         OLC: 335.2 km
         We: 335.23 km
         """
@@ -163,18 +532,12 @@ class Scorer:
         utc_date = parsed['header'][1]['utc_date']
 
         records = records[tow_release_index:]
-        self.lat = np.array([r['lat'] for r in records])
-        self.lon = np.array([r['lon'] for r in records])
-        self.time = np.array(
-            [dt.datetime.combine(utc_date, r['time']) for r in records]
-        )
-        self.raw_time = np.array([((r['time'].hour*60)+r['time'].minute)*60+r['time'].second for r in records])
-        self.alt = np.array([r['pressure_alt'] for r in records])
+        self._set_records(records, utc_date)
 
     def import_sebald5_flight(self):
         """https://www.onlinecontest.org/olc-3.0/gliding/flightinfo.html?dsId=7189530
 
-        122 iterations backward, 150 iterations forward
+        122 end knots checked backward, 150 forward (batch_size=1)
         OLC: 725.3 km
         We: 725.29 km
         """
@@ -192,18 +555,12 @@ class Scorer:
         utc_date = parsed['header'][1]['utc_date']
 
         records = records[tow_release_index:]
-        self.lat = np.array([r['lat'] for r in records])
-        self.lon = np.array([r['lon'] for r in records])
-        self.time = np.array(
-            [dt.datetime.combine(utc_date, r['time']) for r in records]
-        )
-        self.raw_time = np.array([((r['time'].hour*60)+r['time'].minute)*60+r['time'].second for r in records])
-        self.alt = np.array([r['pressure_alt'] for r in records])
+        self._set_records(records, utc_date)
 
     def import_sebald6_flight(self):
         """https://www.onlinecontest.org/olc-3.0/gliding/flightinfo.html?dsId=7062937
 
-        69 iterations backward, 329 iterations forward
+        69 end knots checked backward, 329 forward (batch_size=1)
         OLC: 62.3 km
         We: 62.27 km
         """
@@ -221,13 +578,7 @@ class Scorer:
         utc_date = parsed['header'][1]['utc_date']
 
         records = records[tow_release_index:]
-        self.lat = np.array([r['lat'] for r in records])
-        self.lon = np.array([r['lon'] for r in records])
-        self.time = np.array(
-            [dt.datetime.combine(utc_date, r['time']) for r in records]
-        )
-        self.raw_time = np.array([((r['time'].hour*60)+r['time'].minute)*60+r['time'].second for r in records])
-        self.alt = np.array([r['pressure_alt'] for r in records])
+        self._set_records(records, utc_date)
 
 
     def import_height_difference_flight(self):
@@ -250,13 +601,7 @@ class Scorer:
         utc_date = parsed['header'][1]['utc_date']
 
         records = records[tow_release_index:engine_start_index]
-        self.lat = np.array([r['lat'] for r in records])
-        self.lon = np.array([r['lon'] for r in records])
-        self.time = np.array(
-            [dt.datetime.combine(utc_date, r['time']) for r in records]
-        )
-        self.raw_time = np.array([((r['time'].hour*60)+r['time'].minute)*60+r['time'].second for r in records])
-        self.alt = np.array([r['pressure_alt'] for r in records])
+        self._set_records(records, utc_date)
 
     def import_longer_flight(self):
         tow_release = dt.time(8, 42, 0)
@@ -273,13 +618,7 @@ class Scorer:
         utc_date = parsed['header'][1]['utc_date']
 
         records = records[tow_release_index:]
-        self.lat = np.array([r['lat'] for r in records])
-        self.lon = np.array([r['lon'] for r in records])
-        self.time = np.array(
-            [dt.datetime.combine(utc_date, r['time']) for r in records]
-        )
-        self.raw_time = np.array([((r['time'].hour*60)+r['time'].minute)*60+r['time'].second for r in records])
-        self.alt = np.array([r['pressure_alt'] for r in records])
+        self._set_records(records, utc_date)
 
     def import_perlan_flight(self):
         tow_release = dt.time(16, 54, 10)
@@ -296,13 +635,7 @@ class Scorer:
         utc_date = parsed['header'][1]['utc_date']
 
         records = records[tow_release_index:]
-        self.lat = np.array([r['lat'] for r in records])
-        self.lon = np.array([r['lon'] for r in records])
-        self.time = np.array(
-            [dt.datetime.combine(utc_date, r['time']) for r in records]
-        )
-        self.raw_time = np.array([((r['time'].hour*60)+r['time'].minute)*60+r['time'].second for r in records])
-        self.alt = np.array([r['pressure_alt'] for r in records])
+        self._set_records(records, utc_date)
 
     def import_simple_flight(self):
         test_file = os.path.join(self.test_data_dir, '825lqkk1.igc')
@@ -312,66 +645,222 @@ class Scorer:
         utc_date = parsed['header'][1]['utc_date']
 
         records = parsed['fix_records'][1]
-        self.lat = np.array([r['lat'] for r in records])
-        self.lon = np.array([r['lon'] for r in records])
-        self.time = np.array(
-            [dt.datetime.combine(utc_date, r['time']) for r in records]
+        self._set_records(records, utc_date)
+
+    def simplified_indices(self):
+        """
+        Indices of the fixes that survive Ramer-Douglas-Peucker simplification
+        of the track, which shrinks the number of knots of the DP
+        considerably. Longitude is scaled with the cosine of the mean
+        latitude like in flat_projection, so epsilon is a tolerance in
+        degrees of latitude in every direction.
+        Turnpoints of the optimal path are extreme points of the track, but a
+        dropped fix may still be a little farther out than the kept ones. The
+        result of score and score_backwards is therefore an approximate
+        optimum: every dropped fix lies within epsilon of a kept segment, so
+        the path is shorter by at most 2*epsilon per turnpoint (in the flat
+        projection). Set epsilon to 0 for the exact optimum.
+        Not used with the height constraint, as the best start or finish
+        may well lie on a straight segment of the track.
+        """
+        if not self.epsilon:
+            return np.arange(len(self.lat))
+        lat = np.ascontiguousarray(self.lat, dtype=np.float64)
+        lon = np.ascontiguousarray(self.lon, dtype=np.float64)
+        mask = self.kernel('rdp_mask')(
+            lat, lon * np.cos(np.radians(np.mean(lat))), self.epsilon
         )
-        self.raw_time = np.array([((r['time'].hour*60)+r['time'].minute)*60+r['time'].second for r in records])
-        self.alt = np.array([r['pressure_alt'] for r in records])
+        return np.nonzero(mask)[0]
+
+    def kernel(self, name):
+        """
+        Compiled kernel of the given name: from olc_kernels if
+        use_aot_kernels is set, the jitted one otherwise.
+        """
+        if not self.use_aot_kernels:
+            return JIT_KERNELS[name]
+        if olc_kernels is None:
+            raise ImportError(
+                'olc_kernels is not built, run '
+                'python -m aerofiles.analyse._olc_kernels'
+            )
+        return getattr(olc_kernels, name)
 
-    def simple_dist_matrix(self, latlon):
-        # latlon.shape (10000,2)
+    def flat_projection(self, latlon):
+        """
+        Projects (n,2) shaped latitude and longitude in radians to the plane,
+        scaling longitude with the cosine of the mean latitude. Returns the
+        two coordinate arrays, centered around zero. Euclidean distances of
+        the projected points are used by the DP.
+        """
+        # float32 holds the distances involved with ample precision and
+        # halves the memory traffic of the DP
+        latlon = latlon.astype(np.float32)
         theta = np.cos(np.mean(latlon[:,0]))
         latlon[:,1] *= theta
+        latlon -= np.mean(latlon, axis=0)
+        return (
+            np.ascontiguousarray(latlon[:,0]),
+            np.ascontiguousarray(latlon[:,1])
+        )
 
-        return scipy.spatial.distance.cdist(latlon, latlon, 'euclidean')
-
-    def find_graph(self, dist_matrix, forbidden_start_index=[]):
+    def find_graph(self, x, y, forbidden_start_index=[], use_cuda=True):
         """
         Calculates (l,k) shaped graph where k is the number of knots
         (data points) and l is the number of layers or legs.
         Graph is used to store the optimum distance that can be achieved with
-        l layers at knot k.
+        l layers at knot k. The index graph of the same shape stores the knot
+        of layer l-1 the optimum at (l,k) is reached from.
+        x and y are the coordinates returned by flat_projection.
+        Very long flights are calculated on the GPU if one is available,
+        unless use_cuda is False.
+        """
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        y = np.ascontiguousarray(y, dtype=np.float32)
+        knots = np.shape(x)[0]
+        forbidden_mask = np.zeros(knots, dtype=np.bool_)
+        forbidden_mask[forbidden_start_index] = True
+        if use_cuda and knots >= CUDA_MIN_KNOTS and cuda.is_available():
+            return _find_graph_cuda(x, y, self.layers, forbidden_mask)
+        return self.kernel('find_graph')(x, y, self.layers, forbidden_mask)
+
+    def find_start_graph(self, index_graph):
+        """
+        Calculates (l,k) shaped graph storing the start knot of the optimum
+        path that ends with l layers at knot k.
         """
-        knots = np.shape(dist_matrix)[0]
-        graph = np.zeros((self.layers,knots))
-        graph[0,forbidden_start_index] = -10000
+        return self.kernel('find_start_graph')(index_graph)
 
-        for k in range(0, knots):
-            for l in range(self.layers-1):
-                options_graph = graph[l,:k+1] + dist_matrix[k,:k+1]
-                graph[l+1,k] = np.max(options_graph)
-        return graph
+    def update_graph(self, x, y, graph, index_graph, start_graph,
+                     forbidden_start_index, reverse_from):
+        """
+        Same result as find_graph(x, y, forbidden_start_index) for all
+        knots up to reverse_from, derived from graph and index_graph
+        calculated without forbidden start knots. Only cells whose optimum
+        path starts at a forbidden knot are recalculated, knots after
+        reverse_from are left at zero.
+        """
+        graphs, index_graphs = self.update_graphs(
+            x, y, graph, index_graph, start_graph,
+            [forbidden_start_index], [reverse_from]
+        )
+        return graphs[0], index_graphs[0]
 
-    def find_path(self, graph, dist_matrix, reverse_from=None):
+    def graph_buffers(self, knots):
         """
-        Calculates (k,l) shaped graph where k is the number of knots
-        (data points) and l is the number of layers or legs.
-        Graph is used to store the optimum distance that can be achieved with
-        l layers and knot k.
+        Allocates (c,l,k) shaped graph and index graph for a batch of
+        batch_size end knots, to be passed as out to update_graphs.
+        """
+        shape = (self.batch_size, self.layers, knots)
+        return (
+            np.empty(shape, dtype=np.float32),
+            np.empty(shape, dtype=np.int32)
+        )
+
+    def update_graphs(self, x, y, graph, index_graph, start_graph,
+                      forbidden_start_indices, reverse_froms, out=None):
+        """
+        Like update_graph for a batch of end knots, each with its own
+        forbidden start knots. Returns (c,l,k) shaped graph and index graph,
+        the whole batch is calculated in one parallel sweep.
+        out can be a pair of buffers from graph_buffers with at least one
+        entry per end knot. They are filled in place, so repeated calls do
+        not allocate new graphs. ValueError is raised if they are too small
+        or of the wrong dtype or layout.
+        """
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        y = np.ascontiguousarray(y, dtype=np.float32)
+        assert graph.flags['C_CONTIGUOUS'] and index_graph.flags['C_CONTIGUOUS']
+        batch = len(reverse_froms)
+        knots = np.shape(x)[0]
+        if out is None:
+            shape = (batch, self.layers, knots)
+            out = (
+                np.empty(shape, dtype=np.float32),
+                np.empty(shape, dtype=np.int32)
+            )
+        for buffer, dtype in zip(out, (np.float32, np.int32)):
+            if (buffer.ndim != 3 or len(buffer) < batch or
+                    buffer.shape[1:] != (self.layers, knots)):
+                raise ValueError(
+                    f'out buffer of shape {buffer.shape} does not hold '
+                    f'{batch} graphs of shape {(self.layers, knots)}'
+                )
+            if buffer.dtype != dtype or not buffer.flags['C_CONTIGUOUS']:
+                raise ValueError(
+                    f'out buffer must be a C contiguous {np.dtype(dtype)} array'
+                )
+        graphs, index_graphs = out[0][:batch], out[1][:batch]
+        forbidden_masks = np.zeros((batch, knots), dtype=np.bool_)
+        for c, forbidden_start_index in enumerate(forbidden_start_indices):
+            forbidden_masks[c, forbidden_start_index] = True
+        self.kernel('update_graphs')(
+            x, y, graph, index_graph, start_graph, forbidden_masks,
+            np.asarray(reverse_froms, dtype=np.int64), graphs, index_graphs
+        )
+        return graphs, index_graphs
+
+    def next_candidates(self, distances, lower_bound):
+        """
+        End knots to check next by the height constrained scoring: up to
+        batch_size knots whose distance without height constraint exceeds
+        lower_bound, highest distance first.
+        """
+        remaining = np.nonzero(distances > lower_bound)[0]
+        if len(remaining) > self.batch_size:
+            top = np.argpartition(-distances[remaining], self.batch_size-1)
+            remaining = remaining[top[:self.batch_size]]
+        return remaining[np.lexsort((remaining, -distances[remaining]))]
+
+    def find_forbidden_starts(self, reverse_from):
+        """
+        Knots more than 1000m above the finish at reverse_from, which can not
+        start a path ending there. Found by binary search on the sorted
+        altitudes, in O(log n) plus the size of the result.
+        """
+        cut = np.searchsorted(self.alt_sorted, self.alt[reverse_from]+1000, side='right')
+        return self.alt_argsort[cut:]
+
+    def find_forbidden_stops(self, reverse_from):
+        """
+        Like find_forbidden_starts for the flipped track of
+        score_with_height_backwards: knots of the flipped track more than
+        1000m below its knot reverse_from, which is the start of the flight.
+        """
+        knots = len(self.alt)
+        cut = np.searchsorted(self.alt_sorted, self.alt[knots-1-reverse_from]-1000, side='left')
+        return knots-1 - self.alt_argsort[:cut]
+
+    def find_path(self, graph, index_graph, reverse_from=None):
+        """
+        Traverses the index graph backwards, starting from the knot with the
+        optimum distance in the last layer or from reverse_from. Every step
+        is a single lookup of the predecessor stored by find_graph.
         """
         if reverse_from is not None:
-            path = [reverse_from]
+            p = int(reverse_from)
         else:
-            path = [np.argmax(graph[self.layers-1:])]
+            p = int(np.argmax(graph[self.layers-1]))
 
-        for l in reversed(range(self.layers-1)):
-            path.append(np.argmax(dist_matrix[path[-1],:path[-1]+1]+graph[l,:path[-1]+1]))
-        return list(reversed(path))
+        path = [p]
+        for l in range(self.layers-1, 0, -1):
+            p = int(index_graph[l, p])
+            path.append(p)
+        return path[::-1]
 
     def find_distance(self, path):
         """
         We don't store actual distances in the graph anymore. Therefore the
-        distance needs to be calculated from the indexes
+        distance needs to be calculated from the indexes. The haversine
+        formula is evaluated for all legs at once.
         """
-        total_distance = 0
-        for p1, p2 in zip(path, path[1:]):
-            total_distance += haversine(
-                self.lon[p1], self.lat[p1],
-                self.lon[p2], self.lat[p2],
-            )
-        return total_distance
+        p = np.asarray(path, dtype=np.intp)
+        lat = np.radians(self.lat[p])
+        lon = np.radians(self.lon[p])
+        dlat = np.diff(lat)
+        dlon = np.diff(lon)
+        d = np.sin(dlat*0.5)**2 + np.cos(lat[:-1])*np.cos(lat[1:])*np.sin(dlon*0.5)**2
+        return 2 * EARTH_RADIUS_KM * np.sum(np.arcsin(np.sqrt(d)))
 
     def score(self):
         """
@@ -383,13 +872,14 @@ class Scorer:
         if not(len(self.alt) == len(self.lat) == len(self.lon)):
             return []
 
-        latlon = np.radians(np.column_stack([self.lat, self.lon]))
-        dist_matrix = self.simple_dist_matrix(latlon)
-        graph = self.find_graph(dist_matrix)
-        return self.find_path(graph, dist_matrix)
+        indices = self.simplified_indices()
+        x, y = self.flat_projection(self.latlon_rad[indices])
+        graph, index_graph = self.find_graph(x, y)
+        return list(indices[self.find_path(graph, index_graph)])
 
-    def flip_path(self, path):
-        knots = len(self.lon)
+    def flip_path(self, path, knots=None):
+        if knots is None:
+            knots = len(self.lon)
         return [knots-1-p for p in path][::-1]
 
     def score_backwards(self):
@@ -399,10 +889,11 @@ class Scorer:
         if not(len(self.alt) == len(self.lat) == len(self.lon)):
             return []
 
-        latlon = np.radians(np.column_stack([self.lat[::-1], self.lon[::-1]]))
-        dist_matrix = self.simple_dist_matrix(latlon)
-        graph = self.find_graph(dist_matrix)
-        return self.flip_path(self.find_path(graph, dist_matrix))
+        indices = self.simplified_indices()
+        x, y = self.flat_projection(self.latlon_rad[indices][::-1])
+        graph, index_graph = self.find_graph(x, y)
+        path = self.flip_path(self.find_path(graph, index_graph), len(indices))
+        return list(indices[path])
 
     def score_with_height(self):
         if not(len(self.alt) == len(self.lat) == len(self.lon)):
@@ -411,11 +902,11 @@ class Scorer:
         def check_alt(alt, path):
             return alt[path[0]]-alt[path[-1]] <= 1000
 
-        latlon = np.radians(np.column_stack([self.lat, self.lon]))
-
-        dist_matrix = self.simple_dist_matrix(latlon)
-        graph = self.find_graph(dist_matrix)
-        path = self.find_path(graph, dist_matrix)
+        x, y = self.flat_projection(self.latlon_rad)
+        # update_graphs relies on the cells it does not recalculate being
+        # exactly what the CPU kernel gives, so the base graph stays on CPU
+        graph, index_graph = self.find_graph(x, y, use_cuda=False)
+        path = self.find_path(graph, index_graph)
 
         if check_alt(self.alt, path):
             return path
@@ -424,34 +915,45 @@ class Scorer:
         lower_bound = 0
         best_path = []
         original_graph = np.copy(graph)
+        base_graph, base_index_graph = graph, index_graph
+        start_graph = self.find_start_graph(index_graph)
+        # filled in place by every batch of the loop
+        buffers = self.graph_buffers(len(x))
         iterations = 0
 
         while True:
             iterations += 1
-            reverse_from = np.argmax(graph[self.layers-1,:])
-            forbidden_start_index = np.nonzero(self.alt-self.alt[reverse_from] > 1000)[0]
-
-            graph = self.find_graph(dist_matrix, forbidden_start_index)
-            path = self.find_path(graph, dist_matrix, reverse_from=reverse_from)
+            # best first: the end knots with the highest distance without
+            # height constraint are checked next, a batch at a time
+            candidates = self.next_candidates(original_graph[self.layers-1,:], lower_bound)
+            forbidden_start_indices = [
+                self.find_forbidden_starts(reverse_from)
+                for reverse_from in candidates
+            ]
+
+            graphs, index_graphs = self.update_graphs(
+                x, y, base_graph, base_index_graph, start_graph,
+                forbidden_start_indices, candidates, out=buffers
+            )
+            for c, reverse_from in enumerate(candidates):
+                graph = graphs[c]
+                path = self.find_path(graph, index_graphs[c], reverse_from=reverse_from)
 
-            # some tests while developing
-            for j in forbidden_start_index:
-                assert(path[0]!=j)
-            assert(check_alt(self.alt, path)) # careful with self.alt alt
+                # some tests while developing
+                assert(check_alt(self.alt, path)) # careful with self.alt alt
 
-            distance = graph[self.layers-1,reverse_from]
-            if distance > lower_bound:
-                lower_bound = distance
-                best_path = path
+                distance = graph[self.layers-1,reverse_from]
+                if distance > lower_bound:
+                    lower_bound = distance
+                    best_path = path
 
-            calculated.append(path[-1])
-            graph[self.layers-1, calculated] = 0
+                calculated.append(path[-1])
             original_graph[self.layers-1, calculated] = 0
 
             # do we still have options to check?
             remaining = np.nonzero(original_graph[self.layers-1,:] > lower_bound)[0]
             if not len(remaining):
-                print(f'{iterations} iterations needed')
+                print(f'{len(calculated)} end knots checked in {iterations} batches')
                 return best_path
             print(f'Remaining options: {len(remaining)}')
 
@@ -470,11 +972,11 @@ class Scorer:
         def check_alt(alt, path):
             return self.alt_flipped[path[-1]]-self.alt_flipped[path[0]] <= 1000
 
-        latlon = np.radians(np.column_stack([self.lat[::-1], self.lon[::-1]]))
-
-        dist_matrix = self.simple_dist_matrix(latlon)
-        graph = self.find_graph(dist_matrix)
-        path = self.find_path(graph, dist_matrix)
+        x, y = self.flat_projection(self.latlon_rad[::-1])
+        # update_graphs relies on the cells it does not recalculate being
+        # exactly what the CPU kernel gives, so the base graph stays on CPU
+        graph, index_graph = self.find_graph(x, y, use_cuda=False)
+        path = self.find_path(graph, index_graph)
 
         if check_alt(self.alt, path):
             return self.flip_path(path)
@@ -483,28 +985,41 @@ class Scorer:
         lower_bound = 0
         best_path = []
         original_graph = np.copy(graph)
+        base_graph, base_index_graph = graph, index_graph
+        start_graph = self.find_start_graph(index_graph)
+        # filled in place by every batch of the loop
+        buffers = self.graph_buffers(len(x))
         iterations = 0
 
         while True:
             iterations += 1
-            reverse_from = np.argmax(graph[self.layers-1,:])
-            forbidden_stop_index = np.nonzero(self.alt_flipped[reverse_from]-self.alt_flipped > 1000)[0]
-
-            graph = self.find_graph(dist_matrix, forbidden_stop_index)
-            path = self.find_path(graph, dist_matrix, reverse_from=reverse_from)
+            # best first: the end knots with the highest distance without
+            # height constraint are checked next, a batch at a time
+            candidates = self.next_candidates(original_graph[self.layers-1,:], lower_bound)
+            forbidden_stop_indices = [
+                self.find_forbidden_stops(reverse_from)
+                for reverse_from in candidates
+            ]
+
+            graphs, index_graphs = self.update_graphs(
+                x, y, base_graph, base_index_graph, start_graph,
+                forbidden_stop_indices, candidates, out=buffers
+            )
+            for c, reverse_from in enumerate(candidates):
+                graph = graphs[c]
+                path = self.find_path(graph, index_graphs[c], reverse_from=reverse_from)
 
-            distance = graph[self.layers-1,reverse_from]
-            if distance > lower_bound:
-                lower_bound = distance
-                best_path = path
+                distance = graph[self.layers-1,reverse_from]
+                if distance > lower_bound:
+                    lower_bound = distance
+                    best_path = path
 
-            calculated.append(path[-1])
-            graph[self.layers-1, calculated] = 0
+                calculated.append(path[-1])
             original_graph[self.layers-1, calculated] = 0
 
             # do we still have options to check?
             remaining = np.nonzero(original_graph[self.layers-1,:] > lower_bound)[0]
             if not len(remaining):
-                print(f'{iterations} iterations needed')
+                print(f'{len(calculated)} end knots checked in {iterations} batches')
                 return self.flip_path(best_path)
             print(f'Remaining options: {len(remaining)}')
@@ -0,0 +1,350 @@
+import datetime
+import itertools
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from aerofiles.util.geo import haversine
+from aerofiles.analyse.score import (
+    BLOCK_SIZE, LANES, Scorer, _argmax_sum, _rdp_mask
+)
+
+
+def random_track(knots, seed=0):
+    rng = np.random.RandomState(seed)
+    x = np.cumsum(rng.normal(size=knots)).astype(np.float32)
+    y = np.cumsum(rng.normal(size=knots)).astype(np.float32)
+    return x - x.mean(), y - y.mean()
+
+
+def flat_length(x, y, path):
+    p = np.asarray(path)
+    return np.sum(np.hypot(np.diff(x[p]), np.diff(y[p])))
+
+
+def assert_graphs_equal(graph, index_graph, expected, reverse_from):
+    expected_graph, expected_index_graph = expected
+    np.testing.assert_array_equal(
+        graph[:, :reverse_from+1], expected_graph[:, :reverse_from+1]
+    )
+    np.testing.assert_array_equal(
+        index_graph[:, :reverse_from+1], expected_index_graph[:, :reverse_from+1]
+    )
+
+
+@pytest.mark.parametrize('n', [1, 5, LANES-1, LANES, LANES+1, 3*LANES+7])
+def test_argmax_sum_prefers_first_index_on_ties(n):
+    rng = np.random.RandomState(n)
+    a = rng.randint(0, 3, size=n).astype(np.float32)
+    b = rng.randint(0, 3, size=n).astype(np.float32)
+    best, best_idx = _argmax_sum(a, b, n)
+    assert best == np.max(a+b)
+    assert best_idx == np.argmax(a+b)
+
+
+def test_argmax_sum_ties_across_lanes():
+    n = 4*LANES + 3
+    a = np.zeros(n, dtype=np.float32)
+    b = np.zeros(n, dtype=np.float32)
+    a[[3*LANES+1, LANES+5, 2*LANES+2]] = 1
+    assert _argmax_sum(a, b, n) == (1, LANES+5)
+    assert _argmax_sum(a, b, LANES) == (0, 0)
+
+
+def out_and_back():
+    """
+    Track from 50N to 51.5N and back to 51N at 8E, with some jitter.
+    """
+    rng = np.random.RandomState(5)
+    lat = np.concatenate([np.linspace(50, 51.5, 300), np.linspace(51.5, 51, 100)])
+    lon = 8 + rng.uniform(-1e-5, 1e-5, size=len(lat))
+    return {'lat': lat, 'lon': lon, 'alt': np.zeros(len(lat))}
+
+
+def test_rdp_mask_keeps_out_and_back_turnpoint():
+    data = out_and_back()
+    mask = _rdp_mask(data['lat'], data['lon'] * np.cos(np.radians(50.75)), 3e-5)
+    assert mask[299]
+
+
+@pytest.mark.parametrize('method', ['score', 'score_backwards'])
+def test_simplified_score_within_bound(method):
+    scorer = Scorer(out_and_back())
+    exact = Scorer(out_and_back())
+    exact.epsilon = 0
+    assert len(scorer.simplified_indices()) < len(exact.simplified_indices())
+
+    x, y = scorer.flat_projection(scorer.latlon_rad)
+    length = flat_length(x, y, getattr(scorer, method)())
+    exact_length = flat_length(x, y, getattr(exact, method)())
+    # the bound is in degrees, the projection in radians
+    bound = 2 * np.radians(scorer.epsilon) * scorer.layers
+    assert exact_length - bound <= length <= exact_length
+
+
+@pytest.mark.parametrize('reverse_from', [2*BLOCK_SIZE+50, 3*BLOCK_SIZE-1])
+def test_update_graph_matches_find_graph(reverse_from):
+    scorer = Scorer()
+    x, y = random_track(3*BLOCK_SIZE)
+    graph, index_graph = scorer.find_graph(x, y)
+    start_graph = scorer.find_start_graph(index_graph)
+
+    # forbid the start knots of the unconstrained optimum and a few more
+    forbidden = np.unique(np.concatenate([
+        start_graph[:, reverse_from], np.arange(0, 3*BLOCK_SIZE, 37)
+    ]))
+    new_graph, new_index_graph = scorer.update_graph(
+        x, y, graph, index_graph, start_graph, forbidden, reverse_from
+    )
+    assert_graphs_equal(
+        new_graph, new_index_graph, scorer.find_graph(x, y, forbidden),
+        reverse_from
+    )
+    assert not new_graph[:, reverse_from+1:].any()
+
+
+def test_update_graphs_batch():
+    scorer = Scorer()
+    scorer.batch_size = 3
+    knots = 2*BLOCK_SIZE + 100
+    x, y = random_track(knots, seed=1)
+    graph, index_graph = scorer.find_graph(x, y)
+    start_graph = scorer.find_start_graph(index_graph)
+
+    rng = np.random.RandomState(2)
+    reverse_froms = [knots-1, BLOCK_SIZE+3, 2*BLOCK_SIZE]
+    forbidden = [
+        rng.choice(knots, size=knots//4, replace=False)
+        for _ in reverse_froms
+    ]
+    graphs, index_graphs = scorer.update_graphs(
+        x, y, graph, index_graph, start_graph, forbidden, reverse_froms
+    )
+    assert graphs.shape == (len(reverse_froms), scorer.layers, knots)
+    for c, reverse_from in enumerate(reverse_froms):
+        assert_graphs_equal(
+            graphs[c], index_graphs[c],
+            scorer.find_graph(x, y, forbidden[c]), reverse_from
+        )
+
+
+def height_flight():
+    """
+    Small flight whose unconstrained optimum starts more than 1000m above
+    its finish.
+    """
+    rng = np.random.RandomState(3)
+    knots = 14
+    return {
+        'lat': 50 + rng.uniform(0, 0.5, size=knots),
+        'lon': 8 + rng.uniform(0, 0.5, size=knots),
+        'alt': rng.uniform(0, 3000, size=knots),
+    }
+
+
+@pytest.mark.parametrize('batch_size', [2, 5, 32])
+def test_score_with_height_independent_of_batch_size(batch_size):
+    scorer = Scorer(height_flight())
+    scorer.batch_size = 1
+    paths = [scorer.score_with_height(), scorer.score_with_height_backwards()]
+    scorer.batch_size = batch_size
+    assert [scorer.score_with_height(), scorer.score_with_height_backwards()] == paths
+
+
+def best_path_with_height(scorer, x, y):
+    """
+    Brute force over all paths, with start at most 1000m above the finish.
+    """
+    knots = len(x)
+    best = -1
+    for path in itertools.combinations_with_replacement(range(knots), scorer.layers):
+        if scorer.alt[path[0]] - scorer.alt[path[-1]] > 1000:
+            continue
+        best = max(best, flat_length(x, y, path))
+    return best
+
+
+def test_score_with_height():
+    scorer = Scorer(height_flight())
+    x, y = scorer.flat_projection(scorer.latlon_rad)
+    expected = best_path_with_height(scorer, x, y)
+
+    # the unconstrained optimum violates the height constraint, so the
+    # retry loop runs
+    path = scorer.score()
+    assert scorer.alt[path[0]] - scorer.alt[path[-1]] > 1000
+
+    for method in [scorer.score_with_height, scorer.score_with_height_backwards]:
+        path = method()
+        assert scorer.alt[path[0]] - scorer.alt[path[-1]] <= 1000
+        assert flat_length(x, y, path) == pytest.approx(expected, rel=1e-5)
+
+
+def test_aot_kernels_match_jit_kernels():
+    pytest.importorskip('aerofiles.analyse.olc_kernels')
+    data = {}
+    data['lat'], data['lon'] = random_track(2*BLOCK_SIZE + 30, seed=4)
+    data['lat'] = 50 + 0.01 * data['lat'].astype(np.float64)
+    data['lon'] = 8 + 0.01 * data['lon'].astype(np.float64)
+    data['alt'] = np.linspace(3000, 0, len(data['lat']))
+    jit = Scorer(data)
+    aot = Scorer(data)
+    aot.use_aot_kernels = True
+
+    for method in ['score', 'score_with_height', 'score_with_height_backwards']:
+        assert getattr(aot, method)() == getattr(jit, method)()
+
+
+def test_update_graphs_with_reused_buffers():
+    scorer = Scorer()
+    scorer.batch_size = 3
+    knots = 2*BLOCK_SIZE + 100
+    x, y = random_track(knots, seed=1)
+    graph, index_graph = scorer.find_graph(x, y)
+    start_graph = scorer.find_start_graph(index_graph)
+
+    buffers = scorer.graph_buffers(knots)
+    buffers[0].fill(np.nan)
+    buffers[1].fill(-1)
+    rng = np.random.RandomState(2)
+    batches = [[knots-1, BLOCK_SIZE+3, 2*BLOCK_SIZE], [BLOCK_SIZE-10, knots-50]]
+    for reverse_froms in batches:
+        forbidden = [
+            rng.choice(knots, size=knots//4, replace=False)
+            for _ in reverse_froms
+        ]
+        graphs, index_graphs = scorer.update_graphs(
+            x, y, graph, index_graph, start_graph, forbidden, reverse_froms,
+            out=buffers
+        )
+        assert len(graphs) == len(reverse_froms)
+        assert np.shares_memory(graphs, buffers[0])
+        for c, reverse_from in enumerate(reverse_froms):
+            assert_graphs_equal(
+                graphs[c], index_graphs[c],
+                scorer.find_graph(x, y, forbidden[c]), reverse_from
+            )
+            assert not graphs[c][:, reverse_from+1:].any()
+            assert not index_graphs[c][:, reverse_from+1:].any()
+
+
+def test_update_graphs_rejects_unfit_buffers():
+    scorer = Scorer()
+    scorer.batch_size = 1
+    knots = 300
+    x, y = random_track(knots)
+    graph, index_graph = scorer.find_graph(x, y)
+    start_graph = scorer.find_start_graph(index_graph)
+    graphs, index_graphs = scorer.graph_buffers(knots)
+
+    unfit = [
+        (graphs, index_graphs, 3),
+        (np.empty((3, scorer.layers, knots+1), dtype=np.float32), index_graphs, 1),
+        (graphs.astype(np.float64), index_graphs, 1),
+        (graphs, np.asfortranarray(index_graphs), 1),
+    ]
+    for graph_buffer, index_buffer, batch in unfit:
+        with pytest.raises(ValueError):
+            scorer.update_graphs(
+                x, y, graph, index_graph, start_graph,
+                [[1]] * batch, [100, 200, 299][:batch],
+                out=(graph_buffer, index_buffer)
+            )
+
+
+def test_find_distance_matches_haversine():
+    rng = np.random.RandomState(6)
+    knots = 50
+    data = {
+        'lat': 50 + rng.uniform(-2, 2, size=knots),
+        'lon': 8 + rng.uniform(-2, 2, size=knots),
+        'alt': np.zeros(knots),
+    }
+    scorer = Scorer(data)
+    path = [0, 7, 7, 13, 30, 41, 49]
+    expected = sum(
+        haversine(data['lon'][p1], data['lat'][p1], data['lon'][p2], data['lat'][p2])
+        for p1, p2 in zip(path, path[1:])
+    )
+    assert scorer.find_distance(path) == pytest.approx(expected, rel=1e-12)
+
+
+CUDA_SIM_CHECK = """
+import numpy as np
+from aerofiles.analyse.score import _find_graph, _find_graph_cuda
+
+# the simulator runs every GPU thread in Python, so keep this small
+rng = np.random.RandomState(7)
+x = np.cumsum(rng.normal(size=20)).astype(np.float32)
+y = np.cumsum(rng.normal(size=20)).astype(np.float32)
+forbidden_mask = np.zeros(20, dtype=np.bool_)
+forbidden_mask[[0, 3, 11]] = True
+graph, index_graph = _find_graph(x, y, 3, forbidden_mask)
+cuda_graph, cuda_index_graph = _find_graph_cuda(x, y, 3, forbidden_mask)
+np.testing.assert_allclose(cuda_graph, graph, rtol=1e-5)
+np.testing.assert_array_equal(cuda_index_graph, index_graph)
+"""
+
+
+def test_find_graph_cuda_matches_find_graph():
+    # the simulator has to be enabled before numba is imported
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ, NUMBA_ENABLE_CUDASIM='1')
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [root, env.get('PYTHONPATH')]))
+    result = subprocess.run(
+        [sys.executable, '-c', CUDA_SIM_CHECK], env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    assert result.returncode == 0, result.stdout.decode()
+
+
+def test_forbidden_starts_and_stops():
+    rng = np.random.RandomState(8)
+    knots = 200
+    data = {
+        'lat': np.zeros(knots),
+        'lon': np.zeros(knots),
+        # whole metres, so there are ties and differences of exactly 1000m
+        'alt': rng.randint(0, 6, size=knots) * 500.,
+    }
+    scorer = Scorer(data)
+    alt_flipped = scorer.alt[::-1]
+    for reverse_from in range(knots):
+        np.testing.assert_array_equal(
+            np.sort(scorer.find_forbidden_starts(reverse_from)),
+            np.nonzero(scorer.alt-scorer.alt[reverse_from] > 1000)[0]
+        )
+        np.testing.assert_array_equal(
+            np.sort(scorer.find_forbidden_stops(reverse_from)),
+            np.nonzero(alt_flipped[reverse_from]-alt_flipped > 1000)[0]
+        )
+
+
+def test_set_records():
+    utc_date = datetime.date(2020, 5, 17)
+    records = [
+        {'time': datetime.time(9, 15, 42), 'lat': 51.1, 'lon': 8.2, 'pressure_alt': 412},
+        {'time': datetime.time(9, 15, 46), 'lat': 51.2, 'lon': 8.1, 'pressure_alt': 430},
+        {'time': datetime.time(13, 0, 1), 'lat': 51.0, 'lon': 8.3, 'pressure_alt': 1890},
+    ]
+    scorer = Scorer()
+    scorer._set_records(records, utc_date)
+
+    expected = {
+        'lat': np.array([r['lat'] for r in records]),
+        'lon': np.array([r['lon'] for r in records]),
+        'alt': np.array([r['pressure_alt'] for r in records]),
+        'time': np.array(
+            [datetime.datetime.combine(utc_date, r['time']) for r in records]
+        ),
+        'raw_time': np.array([
+            ((r['time'].hour*60)+r['time'].minute)*60+r['time'].second
+            for r in records
+        ]),
+    }
+    for name, value in expected.items():
+        assert getattr(scorer, name).dtype == value.dtype
+        np.testing.assert_array_equal(getattr(scorer, name), value)